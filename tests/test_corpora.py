@@ -0,0 +1,317 @@
+import hashlib
+import io
+import os
+import struct
+import subprocess
+import sys
+import tarfile
+import tempfile
+import unittest
+from unittest import mock
+
+import lm_dataformat as lmd
+import zstandard
+
+from tools import corpora
+from tools.corpora import (DATA_DOWNLOADERS, DataDownloader, DatasetSpec, PZSTD_SKIPPABLE_MAGIC, _download_one,
+                           _piped_to, _verify, _write_manifest)
+
+try:
+    from tools import preprocess_data
+except ImportError:  # needs torch / megatron
+    preprocess_data = None
+
+DATA = b"".join(b'{"text": "document %d"}\n' % i for i in range(10000))
+
+
+class TestDecompress(unittest.TestCase):
+
+    def _decompress(self, compressed, num_workers):
+        with tempfile.TemporaryDirectory() as data_dir:
+            spec = DatasetSpec("test", ("http://localhost/test.jsonl.zst",))
+            d = DataDownloader(spec, data_dir=data_dir, num_workers=num_workers)
+            os.makedirs(os.path.join(data_dir, spec.name))
+            with open(d._local_paths[0], "wb") as f:
+                f.write(compressed)
+            d.decompress()
+            self.assertFalse(os.path.exists(d._local_paths[0]))
+            with open(os.path.join(data_dir, spec.name, "test.jsonl"), "rb") as f:
+                return f.read()
+
+    def test_single_frame(self):
+        compressed = zstandard.ZstdCompressor().compress(DATA)
+        for num_workers in (1, 4):
+            self.assertEqual(self._decompress(compressed, num_workers), DATA)
+
+    def test_pzstd_frames(self):
+        cctx = zstandard.ZstdCompressor()
+        chunks = [DATA[i:i + 4096] for i in range(0, len(DATA), 4096)]
+        compressed = b""
+        for chunk in chunks:
+            frame = cctx.compress(chunk)
+            compressed += struct.pack("<III", PZSTD_SKIPPABLE_MAGIC, 4, len(frame)) + frame
+        for num_workers in (1, 4):
+            self.assertEqual(self._decompress(compressed, num_workers), DATA)
+
+
+def _write_tar(path, members, mode):
+    with tarfile.open(path, mode) as tar:
+        for name, data in members.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+
+
+class TestExtract(unittest.TestCase):
+
+    def _prepare_inputs(self, data_dir, url, members, mode):
+        d = DataDownloader(DatasetSpec("test", (url,)), data_dir=data_dir, num_workers=2)
+        os.makedirs(os.path.join(data_dir, "test"))
+        _write_tar(d._local_paths[0], members, mode)
+        d.extract()
+        d.decompress()
+        return d._tokenize_inputs()
+
+    def test_tar_gz_is_tokenized_as_is(self):
+        # lm_dataformat reads every member of a .tar.gz as a document, whatever its suffix
+        members = {"papers/a.tex": b"\\section{A}", "papers/b.txt": b"B"}
+        with tempfile.TemporaryDirectory() as data_dir:
+            inputs = self._prepare_inputs(data_dir, "http://localhost/test.tar.gz", members, "w:gz")
+            self.assertEqual(inputs, [os.path.join(data_dir, "test", "test.tar.gz")])
+            docs = [doc for path in inputs for doc in lmd.Reader(path).stream_data()]
+        self.assertEqual(sorted(docs), ["B", "\\section{A}"])
+
+    def test_extracted_members_are_tokenized(self):
+        members = {"a.jsonl.zst": zstandard.ZstdCompressor().compress(DATA), "b.txt": b"B"}
+        with tempfile.TemporaryDirectory() as data_dir:
+            inputs = self._prepare_inputs(data_dir, "http://localhost/test.tar", members, "w")
+            self.assertEqual(inputs, [os.path.join(data_dir, "test", "test", name) for name in ("a.jsonl", "b.txt")])
+            with open(inputs[0], "rb") as f:
+                self.assertEqual(f.read(), DATA)
+
+    def test_unreadable_members_raise(self):
+        with tempfile.TemporaryDirectory() as data_dir:
+            with self.assertRaises(ValueError):
+                self._prepare_inputs(data_dir, "http://localhost/test.tar", {"a.tex": b"A"}, "w")
+
+
+class TestDatasetSpec(unittest.TestCase):
+
+    def test_hashable_and_read_only(self):
+        spec = DatasetSpec("test", ("http://localhost/test.jsonl.zst",), checksums={"http://localhost/test.jsonl.zst": "0" * 64})
+        hash(spec)
+        with self.assertRaises(TypeError):
+            spec.checksums["http://localhost/test.jsonl.zst"] = "1" * 64
+        for spec in DATA_DOWNLOADERS.values():
+            hash(spec)
+
+
+class _FakeResponse:
+
+    def __init__(self, status_code, body=b""):
+        self.status_code = status_code
+        self.raw = io.BytesIO(body)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise RuntimeError(f"HTTP {self.status_code}")
+
+
+class _FakeSession:
+    """answers each get() with the next of `responses`, recording the headers it was sent"""
+
+    def __init__(self, *responses):
+        self._responses = list(responses)
+        self.headers = []
+
+    def get(self, url, headers=None, **kwargs):
+        self.headers.append(headers or {})
+        return self._responses.pop(0)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+class TestDownload(unittest.TestCase):
+
+    def _download(self, existing, response):
+        with tempfile.TemporaryDirectory() as data_dir:
+            dest = os.path.join(data_dir, "test.jsonl.zst")
+            if existing is not None:
+                with open(dest, "wb") as f:
+                    f.write(existing)
+            session = _FakeSession(response)
+            try:
+                _download_one(session, "http://localhost/test.jsonl.zst", dest)
+            finally:
+                with open(dest, "rb") as f:
+                    contents = f.read()
+        return session.headers[0], contents
+
+    def test_fresh(self):
+        headers, contents = self._download(None, _FakeResponse(200, b"abcdef"))
+        self.assertNotIn("Range", headers)
+        self.assertEqual(contents, b"abcdef")
+
+    def test_resume(self):
+        headers, contents = self._download(b"abc", _FakeResponse(206, b"def"))
+        self.assertEqual(headers["Range"], "bytes=3-")
+        self.assertEqual(contents, b"abcdef")
+
+    def test_range_ignored(self):
+        _, contents = self._download(b"abc", _FakeResponse(200, b"abcdef"))
+        self.assertEqual(contents, b"abcdef")
+
+    def test_already_complete(self):
+        _, contents = self._download(b"abcdef", _FakeResponse(416))
+        self.assertEqual(contents, b"abcdef")
+
+    def test_error_keeps_partial_file(self):
+        with self.assertRaises(RuntimeError):
+            self._download(b"abc", _FakeResponse(503))
+
+    def test_verify(self):
+        with tempfile.TemporaryDirectory() as data_dir:
+            path = os.path.join(data_dir, "test.jsonl.zst")
+            with open(path, "wb") as f:
+                f.write(DATA)
+            _verify(path, None)
+            _verify(path, hashlib.sha256(DATA).hexdigest())
+            self.assertTrue(os.path.exists(path))
+            with self.assertRaisesRegex(RuntimeError, "Checksum mismatch"):
+                _verify(path, "0" * 64)
+            self.assertFalse(os.path.exists(path))
+
+    @unittest.skipIf(corpora.requests is None, "requests isn't installed")
+    def test_stream_prepare_checksum_mismatch(self):
+        url = "http://localhost/test.jsonl.zst"
+        spec = DatasetSpec("test", (url,), checksums={url: "0" * 64})
+        cmd = [sys.executable, "-c", "import sys; sys.stdin.buffer.read()"]
+        with tempfile.TemporaryDirectory() as data_dir:
+            d = DataDownloader(spec, data_dir=data_dir, num_workers=2)
+            session = _FakeSession(_FakeResponse(200, zstandard.ZstdCompressor().compress(DATA)))
+            with mock.patch.object(corpora, "_make_session", lambda: session), \
+                    mock.patch.object(DataDownloader, "_tokenize_cmd", lambda self, input_args: cmd):
+                with self.assertRaisesRegex(RuntimeError, "Checksum mismatch"):
+                    d.stream_prepare()
+            self.assertFalse(d.exists())
+
+
+class TestPrepare(unittest.TestCase):
+    PHASES = ("download", "extract", "decompress", "tokenize", "pipelined_prepare")
+
+    def _called_phases(self, urls, sentinels):
+        with tempfile.TemporaryDirectory() as data_dir:
+            d = DataDownloader(DatasetSpec("test", urls), data_dir=data_dir, num_workers=2)
+            os.makedirs(os.path.join(data_dir, "test"))
+            for phase in sentinels:
+                d._mark(phase)
+            mocks = {phase: mock.patch.object(DataDownloader, phase).start() for phase in self.PHASES}
+            try:
+                d.prepare()
+            finally:
+                mock.patch.stopall()
+        return [phase for phase in self.PHASES if mocks[phase].called]
+
+    def test_single_file(self):
+        urls = ("http://localhost/test.tar.gz",)
+        self.assertEqual(self._called_phases(urls, ()), ["download", "extract", "decompress", "tokenize"])
+        self.assertEqual(self._called_phases(urls, ("downloaded",)), ["extract", "decompress", "tokenize"])
+        self.assertEqual(self._called_phases(urls, ("downloaded", "tokenized")), [])
+        self.assertEqual(self._called_phases(urls, ("tokenized",)), [])
+
+    @unittest.skipIf(corpora.requests is None, "requests isn't installed")
+    def test_sharded(self):
+        urls = ("http://localhost/00.jsonl.zst", "http://localhost/01.jsonl.zst")
+        self.assertEqual(self._called_phases(urls, ()), ["pipelined_prepare"])
+        self.assertEqual(self._called_phases(urls, ("downloaded",)), ["extract", "decompress", "tokenize"])
+
+
+def _fake_shard_download(session, url, dest):
+    i = int(os.path.basename(url)[:2])
+    if i == 5 and url.startswith("http://broken/"):
+        raise IOError("connection reset")
+    with open(dest, "wb") as f:
+        f.write(zstandard.ZstdCompressor().compress(b'{"text": "%d"}\n' % i))
+
+
+@unittest.skipIf(corpora.requests is None, "requests isn't installed")
+class TestPipelinedPrepare(unittest.TestCase):
+
+    def _prepare(self, data_dir, host, cmd):
+        urls = tuple(f"http://{host}/{i:02d}.jsonl.zst" for i in range(20))
+        d = DataDownloader(DatasetSpec("test", urls), data_dir=data_dir, num_workers=2)
+        with mock.patch.object(corpora, "_download_one", _fake_shard_download), \
+                mock.patch.object(DataDownloader, "_tokenize_cmd", lambda self, input_args: cmd):
+            d.pipelined_prepare()
+        return d
+
+    def test_shards_are_tokenized_in_order(self):
+        with tempfile.TemporaryDirectory() as data_dir:
+            out = os.path.join(data_dir, "out.jsonl")
+            cmd = [sys.executable, "-c", f"import shutil, sys; shutil.copyfileobj(sys.stdin.buffer, open({out!r}, 'wb'))"]
+            d = self._prepare(data_dir, "localhost", cmd)
+            self.assertTrue(d.exists())
+            self.assertEqual(sorted(os.listdir(os.path.join(data_dir, "test"))), [".tokenized"])
+            with open(out, "rb") as f:
+                self.assertEqual(f.read(), b"".join(b'{"text": "%d"}\n' % i for i in range(20)))
+
+    def test_download_error_stops_tokenization(self):
+        with tempfile.TemporaryDirectory() as data_dir:
+            cmd = [sys.executable, "-c", "import sys, time; sys.stdin.buffer.read(); time.sleep(60)"]
+            with self.assertRaisesRegex(IOError, "connection reset"):
+                self._prepare(data_dir, "broken", cmd)
+            self.assertFalse(os.path.exists(os.path.join(data_dir, "test", ".tokenized")))
+
+
+class TestPipedTo(unittest.TestCase):
+
+    def test_exit_code(self):
+        with self.assertRaises(subprocess.CalledProcessError) as cm:
+            with _piped_to([sys.executable, "-c", "import sys; sys.exit(3)"]) as stdin:
+                stdin.write(b"x")
+        self.assertEqual(cm.exception.returncode, 3)
+
+    def test_exit_code_replaces_broken_pipe(self):
+        with self.assertRaises(subprocess.CalledProcessError) as cm:
+            with _piped_to([sys.executable, "-c", "import sys; sys.exit(3)"]) as stdin:
+                while True:
+                    stdin.write(DATA)
+        self.assertEqual(cm.exception.returncode, 3)
+
+    def test_process_is_terminated_on_error(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            done = os.path.join(tmp_dir, "done")
+            cmd = [sys.executable, "-c", f"import sys; sys.stdin.buffer.read(); open({done!r}, 'w').close()"]
+            with self.assertRaises(KeyError):
+                with _piped_to(cmd) as stdin:
+                    stdin.write(b"x")
+                    raise KeyError("input")
+            # stdin is only closed after the process was terminated, so it never sees the end of its input
+            self.assertFalse(os.path.exists(done))
+
+
+class TestManifest(unittest.TestCase):
+
+    @unittest.skipIf(preprocess_data is None, "preprocess_data.py needs torch and megatron")
+    def test_input_list(self):
+        with tempfile.TemporaryDirectory() as data_dir:
+            paths = [os.path.join(data_dir, "a,b.jsonl"), os.path.join(data_dir, "c.jsonl.zst")]
+            manifest = _write_manifest(paths, os.path.join(data_dir, "shards.txt"))
+            argv = ["preprocess_data.py", "--input-list", manifest, "--output-prefix", "out", "--tokenizer-type", "GPT2BPETokenizer"]
+            with mock.patch.object(sys, "argv", argv):
+                args = preprocess_data.get_args()
+            self.assertEqual(preprocess_data._input_files(args), paths)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -15,22 +15,46 @@
 # limitations under the License.
 
 
+import hashlib
 import os
+import queue
+import struct
 import tarfile
-from abc import ABC, abstractmethod
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from concurrent.futures import ThreadPoolExecutor, wait
+from concurrent.futures import TimeoutError as FuturesTimeoutError
 import shutil
+import subprocess
+import sys
+import threading
+from types import MappingProxyType
+from typing import Mapping, Optional, Tuple
+from urllib.parse import urlparse
 import zstandard
 
+try:
+    import requests
+    from requests.adapters import HTTPAdapter
+except ImportError:
+    requests = None
+
+try:
+    # ISA-L's gzip implementation decompresses several times faster than zlib's
+    from isal import igzip as gzip
+except ImportError:
+    import gzip
+
 """
 This registry is for automatically downloading and extracting datasets.
-To register a class you need to inherit the DataDownloader class, provide name, filetype and url attributes, and 
-(optionally) provide download / extract / exists / tokenize functions to check if the data exists, and, if it doesn't, download, 
-extract and tokenize the data into the correct directory.
-When done, add it to the DATA_DOWNLOADERS dict. The function process_data runs the pre-processing for the selected 
-dataset.
+To register a dataset, add a DatasetSpec (name, urls and optionally num_docs / checksums) to the DATA_DOWNLOADERS dict.
+A DataDownloader built from the spec checks if the data exists, and, if it doesn't, downloads, extracts and tokenizes
+the data into the correct directory. The function prepare_dataset runs the pre-processing for the selected dataset.
 """
 
 DEFAULT_DATA_DIR = os.environ.get('DATA_DIR', './data')
+PREPROCESS_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "preprocess_data.py")
 
 DEFAULT_TOKENIZER_TYPE = "GPT2BPETokenizer"
 GPT2_VOCAB_FP = f"{DEFAULT_DATA_DIR}/gpt2-vocab.json"
@@ -38,11 +62,299 @@ GPT2_VOCAB_URL = "https://s3.amazonaws.com/models.huggingface.co/bert/gpt2-vocab
 GPT2_MERGE_FP = f"{DEFAULT_DATA_DIR}/gpt2-merges.txt"
 GPT2_MERGE_URL = "https://s3.amazonaws.com/models.huggingface.co/bert/gpt2-merges.txt"
 
+DOWNLOAD_CHUNK_SIZE = 1 << 20  # 1 MiB
+ZSTD_STREAM_SIZE = 1 << 17  # 128 KiB
+SHARD_QUEUE_SIZE = 2
+PROCESS_TERMINATE_TIMEOUT = 10  # seconds
+STOP_POLL_INTERVAL = 0.5  # seconds
+TAR_BUFFER_SIZE = 1 << 20  # 1 MiB
+TAR_SUFFIXES = (".tar.gz", ".tgz", ".tar")
+# inputs preprocess_data.py can read: plain .jsonl plus whatever lm_dataformat's Reader handles. lm_dataformat
+# silently skips any other file, and streams .tar.gz (every member is a document) and .jsonl.zst.tar archives itself.
+TOKENIZABLE_SUFFIXES = (".jsonl", ".jsonl.zst", ".jsonl.zst.tar", ".json.zst", ".dat.zst", ".txt", ".zip", ".tar.gz")
+# pzstd precedes every zstd frame with a 12 byte skippable frame (magic, length=4, compressed size of the next frame)
+PZSTD_SKIPPABLE_MAGIC = 0x184D2A50
+PZSTD_HEADER = struct.Struct("<III")
+# number of parallel downloads / connections per host, independent of num_workers so large machines don't hammer
+# the (volunteer run) hosts
+HTTP_POOL_SIZE = 8
+
+
+def _make_session(pool_size=HTTP_POOL_SIZE):
+    """returns a requests session whose keep-alive connection pool is shared by all download threads"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def _download_one(session, url, dest):
+    """
+    Streams `url` into `dest` in DOWNLOAD_CHUNK_SIZE chunks.
+    If a partial file is already present at `dest`, the download resumes from where it stopped using a Range header.
+    """
+    headers = {}
+    if os.path.isfile(dest):
+        headers["Range"] = f"bytes={os.path.getsize(dest)}-"
+    with session.get(url, headers=headers, stream=True, timeout=60) as response:
+        if response.status_code == 416:
+            # the requested range starts at the end of the file, i.e. it was already fully downloaded
+            return dest
+        response.raise_for_status()
+        # servers that ignore the Range header answer with 200 and the full body, so start over in that case
+        mode = "ab" if response.status_code == 206 else "wb"
+        response.raw.decode_content = True
+        with open(dest, mode) as f:
+            shutil.copyfileobj(response.raw, f, DOWNLOAD_CHUNK_SIZE)
+    return dest
+
+
+def _sha256(path):
+    """hex sha256 digest of the file at `path`"""
+    with open(path, "rb") as f:
+        if hasattr(hashlib, "file_digest"):
+            return hashlib.file_digest(f, "sha256").hexdigest()
+        digest = hashlib.sha256()
+        for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b""):
+            digest.update(chunk)
+        return digest.hexdigest()
+
+
+def _check_sha256(name, expected, actual):
+    if actual != expected:
+        raise RuntimeError(f"Checksum mismatch for {name}: expected sha256 {expected}, got {actual}")
+
+
+def _verify(path, expected_sha256):
+    """raises if the file at `path` doesn't match `expected_sha256`, deleting it so the next run downloads it afresh"""
+    if expected_sha256 is None:
+        return
+    actual = _sha256(path)
+    if actual != expected_sha256:
+        os.remove(path)
+    _check_sha256(path, expected_sha256, actual)
+
+
+class _HashingReader:
+    """read()-only wrapper around `raw` that feeds everything read through it into a sha256 digest"""
+
+    def __init__(self, raw):
+        self._raw = raw
+        self.digest = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self._raw.read(size)
+        self.digest.update(data)
+        return data
+
+
+def _download_atomic(session, url, dest):
+    """like _download_one, but `dest` only appears once the download is complete"""
+    os.makedirs(os.path.dirname(dest) or ".", exist_ok=True)
+    partial = f"{dest}.partial"
+    _download_one(session, url, partial)
+    os.replace(partial, dest)
+    return dest
+
+
+def _wget(urls, dest_dir):
+    """
+    Fallback for when requests isn't installed: fetches `urls` into `dest_dir` with one wget process per host,
+    so all files from the same host reuse a single keep-alive connection.
+    """
+    urls_by_host = {}
+    for url in urls:
+        urls_by_host.setdefault(urlparse(url).hostname, []).append(url)
+    procs = [
+        subprocess.Popen(["wget", "--continue", "--tries=3", "-P", dest_dir, *host_urls])
+        for host_urls in urls_by_host.values()
+    ]
+    for proc in procs:
+        if proc.wait() != 0:
+            raise subprocess.CalledProcessError(proc.returncode, proc.args)
+
+
+@contextmanager
+def _piped_to(cmd):
+    """
+    Runs `cmd` and yields its stdin, which is closed and the process waited for on exit.
+    If the body raises anything but BrokenPipeError, the process is terminated instead. If the process fails, a CalledProcessError with its return code is raised rather than the BrokenPipeError
+    that writing to (or closing) the stdin of a process that exited early produces.
+    """
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+    broken_pipe = None
+    try:
+        yield proc.stdin
+    except BrokenPipeError as e:
+        broken_pipe = e
+    except BaseException:
+        # the input is incomplete, so don't let the process run to completion (and e.g. write a partial dataset)
+        proc.terminate()
+        try:
+            proc.wait(timeout=PROCESS_TERMINATE_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+        raise
+    finally:
+        try:
+            proc.stdin.close()
+        except BrokenPipeError as e:
+            broken_pipe = broken_pipe or e
+        proc.wait()
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, cmd)
+    if broken_pipe is not None:
+        raise broken_pipe
+
+
+def _put_unless_stopped(q, item, stop):
+    """puts `item` on `q`, giving up once `stop` is set. Returns whether `item` was put"""
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=STOP_POLL_INTERVAL)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _result_unless_stopped(future, stop):
+    """waits for `future`, giving up once `stop` is set. Returns whether it completed (re-raising its exception)"""
+    while not stop.is_set():
+        try:
+            future.result(timeout=STOP_POLL_INTERVAL)
+            return True
+        except FuturesTimeoutError:
+            pass
+    return False
+
+
+def _decompressed_path(path):
+    """path a downloaded file ends up at once decompress() has run on it"""
+    if path.endswith(".jsonl.zst"):
+        return path[:-len(".zst")]
+    return path
+
+
+def _write_manifest(paths, manifest_path):
+    """
+    Writes `paths` one per line to `manifest_path` and returns it. preprocess_data.py reads such a manifest through
+    --input-list, which avoids comma-joining every input into a single (possibly too long) --input argument.
+    """
+    with open(manifest_path, "w") as f:
+        for path in paths:
+            f.write(f"{path}\n")
+    return manifest_path
 
-class DataDownloader(ABC):
-    """Dataset registry class to automatically download / extract datasets"""
 
-    def __init__(self, tokenizer_type=None, merge_file=None, vocab_file=None, data_dir=None, num_workers=1):
+def _extract_dir(path):
+    """
+    directory the members of the tar archive at `path` are extracted to, or None if it isn't a tar archive
+    or is one preprocess_data.py reads directly
+    """
+    if path.endswith(TOKENIZABLE_SUFFIXES):
+        return None
+    for suffix in TAR_SUFFIXES:
+        if path.endswith(suffix):
+            return path[:-len(suffix)]
+    return None
+
+
+def _walk_files(path):
+    """all files under directory `path`, in a deterministic order"""
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for f in sorted(files):
+            yield os.path.join(root, f)
+
+
+def _pzstd_frames(f):
+    """
+    Returns the (offset, size) of every zstd frame in `f` if it was written with pzstd framing and holds more than
+    one frame, otherwise None. Frames are independent, so they can be decompressed in parallel.
+    `f` is rewound to its start before returning.
+    """
+    try:
+        f.seek(0, os.SEEK_END)
+        end = f.tell()
+        frames = []
+        offset = 0
+        while offset < end:
+            f.seek(offset)
+            header = f.read(PZSTD_HEADER.size)
+            if len(header) < PZSTD_HEADER.size:
+                return None
+            magic, length, frame_size = PZSTD_HEADER.unpack(header)
+            if magic != PZSTD_SKIPPABLE_MAGIC or length != 4:
+                return None
+            offset += PZSTD_HEADER.size
+            frames.append((offset, frame_size))
+            offset += frame_size
+        return frames if len(frames) > 1 else None
+    finally:
+        f.seek(0)
+
+
+_TLS = threading.local()
+
+
+def _get_dctx():
+    """
+    ZstdDecompressor of the calling thread. Decompressors aren't thread safe, but reusing one per thread
+    avoids reallocating its tables and window buffers for every file / frame.
+    """
+    dctx = getattr(_TLS, "dctx", None)
+    if dctx is None:
+        dctx = _TLS.dctx = zstandard.ZstdDecompressor()
+    return dctx
+
+
+def _decompress_frame(data):
+    return _get_dctx().decompressobj().decompress(data)
+
+
+def _decompress_frames(fi, fo, frames, executor, num_workers):
+    """
+    Decompresses `frames` of `fi` on `executor` (of `num_workers` threads), writing them to `fo` in order.
+    At most 2 * num_workers frames are in flight at once to bound memory use.
+    """
+    pending = deque()
+    for offset, size in frames:
+        fi.seek(offset)
+        pending.append(executor.submit(_decompress_frame, fi.read(size)))
+        if len(pending) >= 2 * num_workers:
+            fo.write(pending.popleft().result())
+    while pending:
+        fo.write(pending.popleft().result())
+
+
+def default_num_workers():
+    """all CPUs but one, which is left to the parent process"""
+    return max(1, (os.cpu_count() or 2) - 1)
+
+
+@dataclass(frozen=True)
+class DatasetSpec:
+    """A dataset in the registry"""
+    name: str  # name of dataset, also the directory it is prepared in
+    urls: Tuple[str, ...]  # URLs from which to download dataset
+    num_docs: Optional[int] = None  # number of documents in the dataset (if known)
+    # expected sha256 hex digests (if known), keyed by url
+    checksums: Mapping[str, str] = field(default_factory=dict, hash=False)
+
+    def __post_init__(self):
+        # keep the spec immutable (and the registry holding it read-only) all the way down
+        object.__setattr__(self, "checksums", MappingProxyType(dict(self.checksums)))
+
+
+class DataDownloader:
+    """Downloads / extracts / tokenizes the dataset described by a DatasetSpec"""
+
+    __slots__ = ("_spec", "_tokenizer_type", "_merge_file", "_vocab_file", "_data_dir", "_num_workers",
+                 "_local_paths")
+
+    def __init__(self, spec, tokenizer_type=None, merge_file=None, vocab_file=None, data_dir=None, num_workers=None):
         if tokenizer_type is None:
             tokenizer_type = DEFAULT_TOKENIZER_TYPE
         if merge_file is None:
@@ -56,11 +368,19 @@ class DataDownloader(ABC):
                 assert vocab_file is not None, 'No vocab file provided'
         if data_dir is None:
             data_dir = DEFAULT_DATA_DIR
+        if num_workers is None:
+            num_workers = default_num_workers()
+        elif num_workers == 1 and (os.cpu_count() or 1) > 1:
+            print(f"Warning: preprocessing with a single worker although {os.cpu_count()} CPUs are available - "
+                  f"leave num_workers unset to use all but one of them")
+        self._spec = spec
         self._tokenizer_type = tokenizer_type
         self._merge_file = merge_file
         self._vocab_file = vocab_file
         self._data_dir = data_dir
         self._num_workers = num_workers
+        # paths the files at `urls` are downloaded to
+        self._local_paths = tuple(os.path.join(data_dir, spec.name, os.path.basename(url)) for url in spec.urls)
 
     @property
     def base_dir(self):
@@ -68,16 +388,14 @@ class DataDownloader(ABC):
         return self._data_dir
 
     @property
-    @abstractmethod
     def name(self):
         """name of dataset"""
-        pass
+        return self._spec.name
 
     @property
-    @abstractmethod
     def urls(self):
         """URLs from which to download dataset"""
-        pass
+        return self._spec.urls
 
     @property
     def tokenizer_type(self):
@@ -102,165 +420,341 @@ class DataDownloader(ABC):
     @property
     def num_docs(self):
         """Number of documents in the dataset (if known)"""
-        return None
+        return self._spec.num_docs
+
+    @property
+    def checksums(self):
+        """Expected sha256 hex digests of the files at `urls` (if known), keyed by url"""
+        return self._spec.checksums
+
+    def _sentinel(self, phase):
+        """marker file written once `phase` ("downloaded" / "tokenized") of preparing the dataset has completed"""
+        return os.path.join(self.base_dir, self.name, f".{phase}")
+
+    def _mark(self, phase):
+        open(self._sentinel(phase), "w").close()
 
     def exists(self):
-        """Checks if the dataset is present"""
-        return os.path.isdir(f"{self.base_dir}/{self.name}")
+        """Checks if the dataset is present (i.e. has been tokenized)"""
+        return os.path.isfile(self._sentinel("tokenized"))
+
+    def _download_and_verify(self, session, url, path):
+        _download_one(session, url, path)
+        _verify(path, self.checksums.get(url))
 
     def download(self):
-        """downloads dataset"""
+        """
+        downloads dataset, fetching up to HTTP_POOL_SIZE files in parallel over a shared connection pool.
+        Files with a known checksum are verified once downloaded.
+        """
         os.makedirs(os.path.join(self.base_dir, self.name), exist_ok=True)
-        for url in self.urls:
-            os.system(f"wget {url} -O {os.path.join(self.base_dir, self.name, os.path.basename(url))}")
+        if requests is None:
+            _wget(self.urls, os.path.join(self.base_dir, self.name))
+            for url, path in zip(self.urls, self._local_paths):
+                _verify(path, self.checksums.get(url))
+            self._mark("downloaded")
+            return
+        with _make_session() as session, ThreadPoolExecutor(max_workers=HTTP_POOL_SIZE) as executor:
+            futures = [
+                executor.submit(self._download_and_verify, session, url, path)
+                for url, path in zip(self.urls, self._local_paths)
+            ]
+            wait(futures)
+        for future in futures:
+            # re-raises the first download error, if any
+            future.result()
+        self._mark("downloaded")
+
+    def _files(self):
+        """dataset files on disk, with tar archives replaced by their extracted members"""
+        for path in self._local_paths:
+            extract_dir = _extract_dir(path)
+            if extract_dir is not None and os.path.isdir(extract_dir):
+                yield from _walk_files(extract_dir)
+            else:
+                yield path
+
+    def extract(self):
+        """
+        extracts downloaded tar archives that preprocess_data.py can't read directly into a directory next to them,
+        deleting each archive once done. Archives are read in streaming mode so they are never loaded into memory or scanned for random access.
+        gzip decompression uses ISA-L if the optional `isal` package is installed (`pip install isal`).
+        """
+        # refuse members that would land outside of the extraction directory where tarfile supports it
+        extract_kwargs = {"filter": "data"} if hasattr(tarfile, "data_filter") else {}
+        for path in self._local_paths:
+            extract_dir = _extract_dir(path)
+            if extract_dir is None or not os.path.isfile(path):
+                continue
+            if path.endswith(".tgz"):
+                # decompress outside of tarfile so the (optionally ISA-L accelerated) gzip module is used
+                fileobj = gzip.open(path, "rb")
+                mode = "r|"
+            else:
+                fileobj = open(path, "rb")
+                mode = "r|*"
+            with fileobj, tarfile.open(fileobj=fileobj, mode=mode, bufsize=TAR_BUFFER_SIZE,
+                                       copybufsize=TAR_BUFFER_SIZE) as tar:
+                for member in tar:
+                    tar.extract(member, extract_dir, **extract_kwargs)
+            os.remove(path)
+
+    def decompress(self):
+        """
+        decompresses downloaded .jsonl.zst files to .jsonl, deleting the compressed files once done.
+        Multi-frame (pzstd) files are decompressed frame-parallel on `num_workers` threads.
+        """
+        dctx = _get_dctx()
+        # shared by all files, so its threads (and their decompressors) are reused across shards
+        with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+            for src in list(self._files()):
+                dst = _decompressed_path(src)
+                if dst == src or not os.path.isfile(src):
+                    continue
+                with open(src, "rb") as fi, open(dst, "wb") as fo:
+                    self._decompress_file(dctx, fi, fo, executor)
+                os.remove(src)
+
+    def _decompress_file(self, dctx, fi, fo, executor):
+        """
+        decompresses zstd file `fi` into `fo`, frame-parallel on `executor`'s `num_workers` threads
+        if `fi` is a multi-frame (pzstd) file
+        """
+        frames = _pzstd_frames(fi) if self.num_workers > 1 else None
+        if frames is not None:
+            _decompress_frames(fi, fo, frames, executor, self.num_workers)
+        else:
+            dctx.copy_stream(fi, fo, read_size=ZSTD_STREAM_SIZE, write_size=ZSTD_STREAM_SIZE)
+
+    def _tokenize_cmd(self, input_args, output_prefix=None, num_docs=None):
+        """
+        preprocess_data.py argv, reading its input according to `input_args`:
+        either ["--input", "-"] for jsonl on stdin or ["--input-list", manifest] (see _write_manifest)
+        """
+        if output_prefix is None:
+            output_prefix = os.path.join(self.base_dir, self.name, self.name)
+        if num_docs is None:
+            num_docs = self.num_docs
+        cmd = [
+            sys.executable, PREPROCESS_SCRIPT,
+            *input_args,
+            "--output-prefix", output_prefix,
+            "--vocab-file", self.vocab_file,
+            "--dataset-impl", "mmap",
+            "--tokenizer-type", self.tokenizer_type,
+            "--merge-file", self.merge_file,
+            "--append-eod",
+            "--workers", str(self.num_workers),
+        ]
+        if num_docs is not None:
+            cmd += ["--num-docs", str(num_docs)]
+        return cmd
+
+    def _tokenize_inputs(self):
+        """files preprocess_data.py reads once the dataset is downloaded, extracted and decompressed"""
+        inputs = [_decompressed_path(path) for path in self._files()]
+        unreadable = [path for path in inputs if not path.endswith(TOKENIZABLE_SUFFIXES)]
+        if unreadable:
+            raise ValueError(f'{len(unreadable)} file(s) of dataset "{self.name}" can\'t be read by preprocess_data.py '
+                             f'(supported: {", ".join(TOKENIZABLE_SUFFIXES)}), e.g. {unreadable[:3]}')
+        return inputs
 
     def tokenize(self):
         """tokenizes dataset"""
-        parent_folder = os.path.join(self.base_dir, self.name)
-        jsonl_filepath = ",".join([
-            os.path.join(parent_folder, os.path.basename(url)) 
-            for url in self.urls
-        ])
-
-        cmd = f"python tools/preprocess_data.py \
-            --input {jsonl_filepath} \
-            --output-prefix {parent_folder}/{self.name} \
-            --vocab {self.vocab_file} \
-            --dataset-impl mmap \
-            --tokenizer-type {self.tokenizer_type} \
-            --merge-file {self.merge_file} \
-            --append-eod \
-            --workers {self.num_workers} "
-        
-        if self.num_docs is not None:
-            cmd += f"--num-docs {self.num_docs}"
-    
-        os.system(cmd)
+        manifest = _write_manifest(self._tokenize_inputs(), os.path.join(self.base_dir, self.name, "shards.txt"))
+        subprocess.run(self._tokenize_cmd(["--input-list", manifest]), check=True)
+        self._mark("tokenized")
+
+    def _is_sharded_jsonl_zst(self):
+        return all(url.endswith(".jsonl.zst") for url in self.urls)
 
     def prepare(self):
-        if not self.exists():
+        """
+        downloads, extracts, decompresses and tokenizes the dataset, skipping the phases whose sentinel is present,
+        so a failed tokenization doesn't force a re-download. The exception are multi-shard .jsonl.zst datasets,
+        which go through pipelined_prepare() unless already downloaded; call download() first to keep their shards.
+        """
+        if self.exists():
+            return
+        downloaded = os.path.isfile(self._sentinel("downloaded"))
+        if not downloaded and requests is not None and len(self.urls) > 1 and self._is_sharded_jsonl_zst():
+            self.pipelined_prepare()
+            return
+        if not downloaded:
             self.download()
-            self.tokenize()
-
-
-class Enron(DataDownloader):
-    name = "enron"
-    urls = ["http://eaidata.bmk.sh/data/enron_emails.jsonl.zst"]
-    num_docs = 517401
-
-
-class PileSubset(DataDownloader):
-    name = "pile_00"
-    urls = ["https://the-eye.eu/public/AI/pile/train/00.jsonl.zst"]
-
-
-class Pile(DataDownloader):
-    name = "pile"
-    urls = [f"https://the-eye.eu/public/AI/pile/train/{i:02}.jsonl.zst" for i in range(30)]
-
-
-class Github(DataDownloader):
-    name = "github"
-    urls = ["http://eaidata.bmk.sh/data/github_small.jsonl.zst"]
-
-
-class ArXiv(DataDownloader):
-    name = "arxiv"
-    urls = ["https://the-eye.eu/public/AI/pile_preliminary_components/2020-09-08-arxiv-extracts-nofallback-until-2007-068.tar.gz"]
-
-
-class EuroParl(DataDownloader):
-    name = "europarl"
-    urls = ["https://the-eye.eu/public/AI/pile_preliminary_components/EuroParliamentProceedings_1996_2011.jsonl.zst"]
-
-
-class FreeLaw(DataDownloader):
-    name = "freelaw"
-    urls = ["https://the-eye.eu/public/AI/pile_preliminary_components/FreeLaw_Opinions.jsonl.zst"]
-
-
-class NiH(DataDownloader):
-    name = "nih"
-    urls = ["https://the-eye.eu/public/AI/pile_preliminary_components/NIH_ExPORTER_awarded_grant_text.jsonl.zst"]
-
-
-class PubMed(DataDownloader):
-    name = "pubmed"
-    urls = ["https://the-eye.eu/public/AI/pile_preliminary_components/PMC_extracts.tar.gz"]
-
-
-class Books1(DataDownloader):
-    name = "books1"
-    urls = ["https://the-eye.eu/public/AI/pile_preliminary_components/books1.tar.gz"]
-
-
-class Books3(DataDownloader):
-    name = "books3"
-    urls = ["https://the-eye.eu/public/AI/pile_preliminary_components/books3.tar.gz"]
-
-
-class HackerNews(DataDownloader):
-    name = "hackernews"
-    urls = ["https://the-eye.eu/public/AI/pile_preliminary_components/hn.tar.gz"]
-
-
-class OpenWebText2(DataDownloader):
-    name = "openwebtext2"
-    urls = ["https://the-eye.eu/public/AI/pile_preliminary_components/openwebtext2.jsonl.zst.tar"]
-
-
-class StackExchange(DataDownloader):
-    name = "stackexchange"
-    urls = ["https://the-eye.eu/public/AI/pile_preliminary_components/stackexchange_dataset.tar"]
-
-
-class UbuntuIRC(DataDownloader):
-    name = "ubuntu_irc"
-    urls = ["https://the-eye.eu/public/AI/pile_preliminary_components/ubuntu_irc_until_2020_9_1.jsonl.zst"]
-
-
-class YoutubeSubtitles(DataDownloader):
-    name = "youtube_subtitles"
-    urls = ["https://the-eye.eu/public/AI/pile_preliminary_components/yt_subs.jsonl.zst"]
+        self.extract()
+        self.decompress()
+        self.tokenize()
+
+    def stream_prepare(self):
+        """
+        Downloads, decompresses and tokenizes the dataset in a single pass without writing the shards to disk:
+        each HTTP response is decompressed on the fly and piped straight into preprocess_data.py's stdin.
+        Shards with a known checksum are hashed as they stream by, and a mismatch fails the run.
+        Datasets that aren't made of .jsonl.zst shards (e.g. tar archives) fall back to prepare(), as does
+        everything when requests isn't installed.
+        """
+        if requests is None or not self._is_sharded_jsonl_zst():
+            return self.prepare()
+        if self.exists():
+            return
+        os.makedirs(os.path.join(self.base_dir, self.name), exist_ok=True)
+        dctx = _get_dctx()
+        with _piped_to(self._tokenize_cmd(["--input", "-"])) as stdin, _make_session() as session:
+            for url in self.urls:
+                with session.get(url, stream=True, timeout=60) as response:
+                    response.raise_for_status()
+                    response.raw.decode_content = True
+                    reader = _HashingReader(response.raw)
+                    dctx.copy_stream(reader, stdin, read_size=ZSTD_STREAM_SIZE, write_size=DOWNLOAD_CHUNK_SIZE)
+                if url in self.checksums:
+                    _check_sha256(url, self.checksums[url], reader.digest.hexdigest())
+        self._mark("tokenized")
+
+    def _download_shards(self, shards, stop):
+        """
+        downloader thread of pipelined_prepare(): downloads up to HTTP_POOL_SIZE shards at once and puts their paths
+        on `shards` in order as they finish, then None - or the exception that stopped it. Gives up once `stop` is set.
+        """
+        session = _make_session()
+        executor = ThreadPoolExecutor(max_workers=HTTP_POOL_SIZE)
+        pending = deque()
+
+        def hand_over_oldest():
+            future, path = pending.popleft()
+            return _result_unless_stopped(future, stop) and _put_unless_stopped(shards, path, stop)
+
+        try:
+            for url, path in zip(self.urls, self._local_paths):
+                pending.append((executor.submit(self._download_and_verify, session, url, path), path))
+                if len(pending) >= HTTP_POOL_SIZE and not hand_over_oldest():
+                    return
+            while pending:
+                if not hand_over_oldest():
+                    return
+            _put_unless_stopped(shards, None, stop)
+        except Exception as e:
+            _put_unless_stopped(shards, e, stop)
+        finally:
+            # downloads that are still running are abandoned, and resumed by the next run
+            for future, _ in pending:
+                future.cancel()
+            executor.shutdown(wait=False)
+            session.close()
+
+    def pipelined_prepare(self):
+        """
+        Overlaps downloading a dataset's .jsonl.zst shards with tokenizing them: a downloader thread fetches up to
+        HTTP_POOL_SIZE shards in parallel and hands finished ones over a queue of SHARD_QUEUE_SIZE, in order, while the
+        calling thread decompresses each one into the stdin of a single preprocess_data.py process and deletes it,
+        so only a bounded number of raw shards are on disk at any time.
+        As tokenization can't resume part way, no .downloaded sentinel is written: if it fails, the shards it already
+        consumed are downloaded again on the next run (shards still on disk are reused / resumed).
+        """
+        os.makedirs(os.path.join(self.base_dir, self.name), exist_ok=True)
+        shards = queue.Queue(maxsize=SHARD_QUEUE_SIZE)
+        stop = threading.Event()
+        downloader = threading.Thread(target=self._download_shards, args=(shards, stop), daemon=True)
+        dctx = _get_dctx()
+        try:
+            with ThreadPoolExecutor(max_workers=self.num_workers) as executor, \
+                    _piped_to(self._tokenize_cmd(["--input", "-"])) as stdin:
+                downloader.start()
+                while True:
+                    path = shards.get()
+                    if path is None:
+                        break
+                    if isinstance(path, Exception):
+                        raise path
+                    with open(path, "rb") as fi:
+                        self._decompress_file(dctx, fi, stdin, executor)
+                    os.remove(path)
+        finally:
+            # unblocks the downloader if we stopped early
+            stop.set()
+            if downloader.is_alive():
+                downloader.join()
+        self._mark("tokenized")
 
 def maybe_download_gpt2_tokenizer_data(tokenizer_type):
     if tokenizer_type is None or tokenizer_type == DEFAULT_TOKENIZER_TYPE:
-        if not os.path.isfile(GPT2_VOCAB_FP):
-            os.system(f'wget {GPT2_VOCAB_URL} -O {GPT2_VOCAB_FP}')
-        if not os.path.isfile(GPT2_MERGE_FP):
-            os.system(f'wget {GPT2_MERGE_URL} -O {GPT2_MERGE_FP}')
-
-
-DATA_DOWNLOADERS = {
-    "enron": Enron,
-    "pile_subset": PileSubset,
-    "pile": Pile,
-    "github": Github,
-    "arxiv": ArXiv,
-    "europarl": EuroParl,
-    "freelaw": FreeLaw,
-    "nih": NiH,
-    "pubmed": PubMed,
-    "books1": Books1,
-    "books3": Books3,
-    "hackernews": HackerNews,
-    "openwebtext2": OpenWebText2,
-    "stackexchange": StackExchange,
-    "ubuntu_irc": UbuntuIRC,
-    "youtube_subtitles": YoutubeSubtitles
-}
-
-def prepare_dataset(dataset_name: str, tokenizer_type: str = None, data_dir: str = None, vocab_file: str = None, merge_file: str = None, num_workers: int = 1):
+        missing = [
+            (url, fp) for url, fp in ((GPT2_VOCAB_URL, GPT2_VOCAB_FP), (GPT2_MERGE_URL, GPT2_MERGE_FP))
+            if not os.path.isfile(fp)
+        ]
+        if not missing:
+            return
+        # files are only moved into place once complete, so a crash never leaves a truncated vocab / merge file behind
+        if requests is None:
+            partial_dir = os.path.join(DEFAULT_DATA_DIR, ".partial")
+            _wget([url for url, _ in missing], partial_dir)
+            for url, fp in missing:
+                os.replace(os.path.join(partial_dir, os.path.basename(url)), fp)
+            return
+        with _make_session(len(missing)) as session, ThreadPoolExecutor(max_workers=len(missing)) as executor:
+            futures = [executor.submit(_download_atomic, session, url, fp) for url, fp in missing]
+        for future in futures:
+            future.result()
+
+
+def tokenize_many(downloaders, output_prefix):
+    """
+    Tokenizes several datasets (already downloaded, extracted and decompressed) into a single output with one
+    preprocess_data.py run, so the tokenizer is only loaded once. All downloaders must use the same tokenizer.
+    """
+    first = downloaders[0]
+    for d in downloaders[1:]:
+        assert (d.tokenizer_type, d.vocab_file, d.merge_file) == (first.tokenizer_type, first.vocab_file, first.merge_file), \
+            f'Dataset "{d.name}" uses a different tokenizer than "{first.name}"'
+    inputs = [path for d in downloaders for path in d._tokenize_inputs()]
+    num_docs = [d.num_docs for d in downloaders]
+    num_docs = None if None in num_docs else sum(num_docs)
+    manifest = _write_manifest(inputs, f"{output_prefix}_shards.txt")
+    cmd = first._tokenize_cmd(["--input-list", manifest], output_prefix=output_prefix, num_docs=num_docs)
+    subprocess.run(cmd, check=True)
+
+
+DATA_DOWNLOADERS = MappingProxyType({
+    "enron": DatasetSpec("enron", ("http://eaidata.bmk.sh/data/enron_emails.jsonl.zst",), num_docs=517401),
+    "pile_subset": DatasetSpec("pile_00", ("https://the-eye.eu/public/AI/pile/train/00.jsonl.zst",)),
+    "pile": DatasetSpec("pile", tuple("https://the-eye.eu/public/AI/pile/train/%02d.jsonl.zst" % i for i in range(30))),
+    "github": DatasetSpec("github", ("http://eaidata.bmk.sh/data/github_small.jsonl.zst",)),
+    "arxiv": DatasetSpec("arxiv", ("https://the-eye.eu/public/AI/pile_preliminary_components/2020-09-08-arxiv-extracts-nofallback-until-2007-068.tar.gz",)),
+    "europarl": DatasetSpec("europarl", ("https://the-eye.eu/public/AI/pile_preliminary_components/EuroParliamentProceedings_1996_2011.jsonl.zst",)),
+    "freelaw": DatasetSpec("freelaw", ("https://the-eye.eu/public/AI/pile_preliminary_components/FreeLaw_Opinions.jsonl.zst",)),
+    "nih": DatasetSpec("nih", ("https://the-eye.eu/public/AI/pile_preliminary_components/NIH_ExPORTER_awarded_grant_text.jsonl.zst",)),
+    "pubmed": DatasetSpec("pubmed", ("https://the-eye.eu/public/AI/pile_preliminary_components/PMC_extracts.tar.gz",)),
+    "books1": DatasetSpec("books1", ("https://the-eye.eu/public/AI/pile_preliminary_components/books1.tar.gz",)),
+    "books3": DatasetSpec("books3", ("https://the-eye.eu/public/AI/pile_preliminary_components/books3.tar.gz",)),
+    "hackernews": DatasetSpec("hackernews", ("https://the-eye.eu/public/AI/pile_preliminary_components/hn.tar.gz",)),
+    "openwebtext2": DatasetSpec("openwebtext2", ("https://the-eye.eu/public/AI/pile_preliminary_components/openwebtext2.jsonl.zst.tar",)),
+    "stackexchange": DatasetSpec("stackexchange", ("https://the-eye.eu/public/AI/pile_preliminary_components/stackexchange_dataset.tar",)),
+    "ubuntu_irc": DatasetSpec("ubuntu_irc", ("https://the-eye.eu/public/AI/pile_preliminary_components/ubuntu_irc_until_2020_9_1.jsonl.zst",)),
+    "youtube_subtitles": DatasetSpec("youtube_subtitles", ("https://the-eye.eu/public/AI/pile_preliminary_components/yt_subs.jsonl.zst",)),
+})
+
+# lookup table / error message used by prepare_dataset, built once at import
+_DOWNLOADERS_LC = {k.lower(): v for k, v in DATA_DOWNLOADERS.items()}
+_DATASET_NAMES = tuple(sorted(_DOWNLOADERS_LC))
+_UNKNOWN_DATASET_MSG = 'Dataset "{}" not recognized - please choose from ' + str(list(_DATASET_NAMES))
+
+
+def prepare_dataset(dataset_name: str, tokenizer_type: str = None, data_dir: str = None, vocab_file: str = None, merge_file: str = None, num_workers: int = None, stream: bool = False):
     """
     Downloads + tokenizes a dataset in the registry (dataset_name) and saves output .npy files to data_dir.
+    num_workers defaults to all CPUs but one.
+    If stream is True, shards are piped from the network into the tokenizer without being written to disk.
     """
     if data_dir is None:
         data_dir = DEFAULT_DATA_DIR
     os.makedirs(data_dir, exist_ok=True)
     maybe_download_gpt2_tokenizer_data(tokenizer_type)
-    DownloaderClass = DATA_DOWNLOADERS.get(dataset_name.lower(), None)
-    if DownloaderClass is None:
-        raise NotImplementedError(f'Dataset "{dataset_name}" not recognized - please choose from {list(DATA_DOWNLOADERS.keys())}')
+    spec = _DOWNLOADERS_LC.get(dataset_name.lower(), None)
+    if spec is None:
+        raise NotImplementedError(_UNKNOWN_DATASET_MSG.format(dataset_name))
     else:
-        d = DownloaderClass(tokenizer_type=tokenizer_type, vocab_file=vocab_file, merge_file=merge_file, data_dir=data_dir, num_workers=num_workers)
-        d.prepare()
+        d = DataDownloader(spec, tokenizer_type=tokenizer_type, vocab_file=vocab_file, merge_file=merge_file, data_dir=data_dir, num_workers=num_workers)
+        if stream:
+            d.stream_prepare()
+        else:
+            d.prepare()
@@ -16,6 +16,7 @@
 """Processing data for pretraining."""
 
 import argparse
+import io
 import json
 import multiprocessing
 import os
@@ -103,8 +104,11 @@ class Encoder(object):
 def get_args():
     parser = argparse.ArgumentParser()
     group = parser.add_argument_group(title='input data')
-    group.add_argument('--input', type=str, required=True,
-                       help='Path to input lmd archives')
+    inputs = group.add_mutually_exclusive_group(required=True)
+    inputs.add_argument('--input', type=str,
+                        help='Path to input lmd archives (comma separated), or - to read jsonl from stdin')
+    inputs.add_argument('--input-list', type=str,
+                        help='Path to a file listing input lmd archives, one per line (as written by tools/corpora.py)')
     group.add_argument('--json-keys', nargs='+', default=['text'],
                        help='space separate listed of keys to extract from json')
     group.add_argument('--split-sentences', action='store_true',
@@ -146,17 +150,40 @@ def get_args():
     return args
 
 
+def _read_jsonl(f):
+    # same handling as lm_dataformat's .jsonl.zst reader: list-valued "text" is joined into paragraphs,
+    # and lines holding a bare string are documents themselves
+    objs = (json.loads(line) for line in f if line.strip())
+    yield from lmd.handle_jsonl(objs, get_meta=False, autojoin_paragraphs=True, para_joiner="\n\n")
+
+
 def _multi_lmd(fnames):
     for fname in fnames:
-        yield from filter(lambda x: x, lmd.Reader(fname).stream_data())
+        if fname == "-":
+            # decompressed jsonl piped in by tools/corpora.py (DataDownloader.stream_prepare)
+            yield from filter(lambda x: x, _read_jsonl(io.TextIOWrapper(sys.stdin.buffer, encoding="utf-8")))
+        elif fname.endswith(".jsonl"):
+            # plain (already decompressed) jsonl, as written by tools/corpora.py
+            with open(fname, encoding="utf-8") as f:
+                yield from filter(lambda x: x, _read_jsonl(f))
+        else:
+            yield from filter(lambda x: x, lmd.Reader(fname).stream_data())
+
+
+def _input_files(args):
+    if args.input_list is not None:
+        print("Opening inputs listed in", args.input_list)
+        with open(args.input_list) as f:
+            return [line.strip() for line in f if line.strip()]
+    print("Opening", args.input)
+    return args.input.split(",")
 
 
 def main():
     args = get_args()
     startup_start = time.time()
 
-    print("Opening", args.input)
-    fin = _multi_lmd(args.input.split(","))
+    fin = _multi_lmd(_input_files(args))
 
     if nltk_available and args.split_sentences:
         nltk.download("punkt", quiet=True)